@@ -23,10 +23,11 @@
 
 from __future__ import print_function
 import argparse
-import collections
+import concurrent.futures
+import datetime
+import functools
 import glob
 import os
-import re
 import sys
 from lxml import etree
 
@@ -49,35 +50,80 @@ def utf8toascii(str):
             ret += '?'
     return ret
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-i', '--inDir', type=str, required=True,
-                    help="location of MSN chat logs (in XML format)")
-parser.add_argument('-m', '--mainUsersEmail', type=str, required=True,
-                    help="main user's email")
-args = parser.parse_args()
-
-try:
-    os.chdir(args.inDir)
-except OSError:
-    eprint("error: failed to change to directory '%s'" % args.inDir)
-    sys.exit(1)
+# Posts are identified by their timestamp, stored as an integer number
+# of microseconds since the Unix epoch (UTC). Integers are much cheaper
+# to compare, hash and store than the original DateTime strings.
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+# Blank conversations (see main) get made-up posts numbered upwards from
+# BLANK_POST_BASE, which sorts before any real timestamp.
+EARLIEST_POST = (datetime.datetime.min.replace(tzinfo=datetime.timezone.utc) - EPOCH) // ONE_MICROSECOND
+BLANK_POST_BASE = -(1 << 62)
+
+def parsePost(dateTime):
+    # e.g. "2005-03-04T20:14:33.123Z". Before Python 3.11, fromisoformat
+    # only takes 0, 3 or 6 fraction digits, so pad (or trim) the
+    # fraction to 6 digits first.
+    s = dateTime.replace('Z', '+00:00')
+    head, dot, rest = s.partition('.')
+    if dot:
+        i = 0
+        while i < len(rest) and rest[i].isdigit():
+            i += 1
+        if i > 0:
+            s = head + '.' + rest[:i][:6].ljust(6, '0') + rest[i:]
+    try:
+        dt = datetime.datetime.fromisoformat(s)
+    except ValueError:
+        raise ValueError("invalid DateTime '%s'" % dateTime)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return (dt - EPOCH) // ONE_MICROSECOND
+
+def formatPost(post):
+    if post < EARLIEST_POST:
+        return "0000-%010d" % (post - BLANK_POST_BASE)
+    dt = EPOCH + datetime.timedelta(microseconds=post)
+    return dt.isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+# POST_TAGS: the XML elements in a chat log that count as posts
+POST_TAGS = frozenset(('Join', 'Message', 'Leave', 'Invitation', 'InvitatationResponse'))
 
 # contacts: a global list of all contacts by email address (mapping from
-#           email -> Contact)
-contacts = collections.OrderedDict()
+#           email -> Contact, in the order the contacts were read in;
+#           plain dicts preserve insertion order as of Python 3.7)
+contacts = {}
 
 # posts: a global list of all important posts (across all logs), and
-#        which sessions they appear in (mapping from post -> Session[])
+#        which sessions they appear in (mapping from post -> Session[]).
+#        Since posts are integer timestamps, a post is its own integer
+#        ID and hashes to itself.
 posts = {}
 
 def addGlobalPost(post, session):
-    if post in posts:
-        posts[post].append(session)
+    # one dict lookup in the common case, instead of two
+    sessions = posts.get(post)
+    if sessions is not None:
+        sessions.append(session)
     else:
         posts[post] = [session]
 
-# edges: a global list of all edges on the graph
-Edge = collections.namedtuple('Edge', ['src', 'dest', 'color'])
+# earliestSessions, latestSessions: for each post, the session that
+#        contains it and has the oldest first post / newest last post
+#        (mappings from post -> Session). These are filled in by
+#        indexPosts once all posts have been read in, so that
+#        buildConversationByPost can pick them out directly.
+earliestSessions = {}
+latestSessions = {}
+
+# contactsAtPost: for each post, the distinct contacts who have it in one
+#        of their sessions, in posts[post] order (mapping from
+#        post -> tuple of Contacts). Also filled in by indexPosts.
+contactsAtPost = {}
+
+# edges: a global list of all edges on the graph, as plain
+#        (src, dest, color) tuples
 edges = []
 
 class Session:
@@ -85,29 +131,62 @@ class Session:
         self.id = id
         self.contact = contact
         self.posts = []
+        # the last post in self.posts (or None), kept separately so
+        # addPost doesn't have to look it up every time
+        self.lastPost = None
 
     # also adds to the global post list! (i.e. it calls addGlobalPost)
     def addPost(self, post):
-        if len(self.posts) > 0 and post <= self.posts[-1]:
+        lastPost = self.lastPost
+        if lastPost is not None and post <= lastPost:
             eprint("warning: non-monotonic timestamp: %s <= %s; dropping post"
-                   % (post, self.posts[len(self.posts)-1]))
+                   % (formatPost(post), formatPost(lastPost)))
             return
 
         self.posts.append(post)
+        self.lastPost = post
         addGlobalPost(post, self)
 
+# sort keys for sessions, used by indexPosts
+def sessionFirstPost(session):
+    return session.posts[0]
+
+def sessionLastPost(session):
+    return session.posts[-1]
+
+def indexPosts():
+    # Must be called after the last addPost, since a session's last post
+    # keeps changing until then.
+    for post, sessions in posts.items():
+        earliestSessions[post] = min(sessions, key = sessionFirstPost)
+        latestSessions[post] = max(sessions, key = sessionLastPost)
+        contactsAtPost[post] = tuple(dict.fromkeys(session.contact for session in sessions))
+
 class Contact:
     def __init__(self, email):
         self.email = email
-        self.sessions = []
-
-    def reserveSessions(self, sessionCount):
-        # reserve space for "sessionCount" sessions
-        for sessionId in range(len(self.sessions)+1, sessionCount+1):
-            self.sessions.append(Session(sessionId, self))
+        # sessions: a mapping from sessionId -> Session. Sessions are
+        # created the first time they're asked for, since a log may
+        # claim hundreds of sessions (LastSessionID) but only contain
+        # a handful of them.
+        self.sessions = {}
+        self.firstConvo = None
 
     def getSession(self, sessionId):
-        return self.sessions[sessionId-1]
+        session = self.sessions.get(sessionId)
+        if session is None:
+            session = Session(sessionId, self)
+            self.sessions[sessionId] = session
+        return session
+
+    def getFirstConvo(self):
+        # Our first conversation is asked for once by the main loop and
+        # then again by every isFormerContactTo test we're a part of,
+        # so hang on to it here. (buildConversationByPost is cached
+        # too, which covers contacts who share the same first post.)
+        if self.firstConvo is None:
+            self.firstConvo = buildConversationByPost(self.getSession(1).posts[0])
+        return self.firstConvo
 
     def isFormerContactTo(self, other):
         # Person A is a "former contact" to B if we have chat logs with
@@ -120,20 +199,44 @@ class Contact:
         if myFirstPost >= hisFirstPost:
             return False
 
-        myFirstConvo = buildConversationByPost(myFirstPost)
-        hisFirstConvo = buildConversationByPost(hisFirstPost)
+        # My first conversation can't start any later than my first
+        # post, so if my first post is older than the start of his first
+        # conversation, we must be in separate conversations, and there's
+        # no need to build mine. (His has usually been built already,
+        # since the main loop built it when it asked us.)
+        hisFirstConvo = other.getFirstConvo()
+        if myFirstPost < hisFirstConvo.firstPost:
+            return True
+
+        myFirstConvo = self.getFirstConvo()
         return (myFirstConvo.firstPost < hisFirstConvo.firstPost)
 
-Participant = collections.namedtuple('Participant', ['email', 'firstPost', 'lastPost'])
+# One of these per contact per conversation, so use __slots__ to keep
+# them small.
+class Participant:
+    __slots__ = ('email', 'firstPost', 'lastPost')
+
+    def __init__(self, email, firstPost, lastPost):
+        self.email = email
+        self.firstPost = firstPost
+        self.lastPost = lastPost
 
 class Conversation:
     def __init__(self, participants):
-        # participants: An array of (email, firstPost, lastPost) triples
+        # participants: An array of Participants
         self.participants = participants
 
         # precompute the first and last post in the conversation
-        self.firstPost = min(participants, key = lambda par: par.firstPost).firstPost
-        self.lastPost = max(participants, key = lambda par: par.lastPost).lastPost
+        # (in a single pass over the participants)
+        firstPost = participants[0].firstPost
+        lastPost = participants[0].lastPost
+        for par in participants:
+            if par.firstPost < firstPost:
+                firstPost = par.firstPost
+            if par.lastPost > lastPost:
+                lastPost = par.lastPost
+        self.firstPost = firstPost
+        self.lastPost = lastPost
 
 # Interval = collections.namedtuple('Interval', ['firstPost', 'lastPost'])
 # We don't want to use a namedtuple, since namedtuples are immutable,
@@ -143,10 +246,17 @@ class Interval:
         self.firstPost = firstPost
         self.lastPost = lastPost
 
+# Only Contact.getFirstConvo calls this, and it already keeps each
+# contact's first conversation; the cache here just lets contacts whose
+# first posts are the same share one conversation. The posts map must
+# not change after this is first called, and indexPosts must already
+# have been called. Callers must treat the returned Conversation as
+# read-only.
+@functools.lru_cache(maxsize=None)
 def buildConversationByPost(post):
     # intervals: a list of all contacts in the conversation and
     # their intervals (a mapping from contact -> Interval)
-    intervals = collections.OrderedDict()
+    intervals = {}
 
     # walk backwards to find the earliest person in the conversation
     sessionA = posts[post][0]
@@ -156,12 +266,16 @@ def buildConversationByPost(post):
         # session doesn't go any further back in time than ours, then
         # we're done.
         firstPostA = sessionA.posts[0]
-        nextSessionA = min(posts[firstPostA], key = lambda session: session.posts[0])
+        nextSessionA = earliestSessions[firstPostA]
         if nextSessionA.posts[0] >= firstPostA:
             break
         sessionA = nextSessionA
 
-    prevPresentContacts = set()
+    # presentContacts: everyone who was present at the previous post,
+    # mapped to the most recent post at which they were present. This
+    # is updated in place as we go, rather than building new sets of
+    # present/added/deleted contacts at every post.
+    presentContacts = {}
     warnedContacts = set()
     prevPost = None
 
@@ -171,17 +285,20 @@ def buildConversationByPost(post):
     # this person's session. Then go to the next person's session.
     while True:
         for p in sessionA.posts:
-            if prevPost and p <= prevPost:
+            if prevPost is not None and p <= prevPost:
                 continue
 
-            presentContacts = set()
-            for sessionB in posts[p]:
-                presentContacts.add(sessionB.contact)
+            prevPresentCount = len(presentContacts)
+            stillPresentCount = 0
 
-            addedContacts = presentContacts - prevPresentContacts
-            deletedContacts = prevPresentContacts - presentContacts
+            for contactB in contactsAtPost[p]:
+                lastSeen = presentContacts.get(contactB)
+                presentContacts[contactB] = p
+                if lastSeen is not None:
+                    stillPresentCount += 1
+                    continue
 
-            for contactB in addedContacts:
+                # B was just added to the conversation.
                 if contactB in intervals:
                     # We already have an interval for B. This means
                     # B left the conversation earlier and re-entered.
@@ -197,19 +314,25 @@ def buildConversationByPost(post):
                 # the lastPost undefined until he gets deleted.
                 intervals[contactB] = Interval(p, None)
 
-            for contactB in deletedContacts:
-                interval = intervals[contactB]
-                if interval.lastPost == None:
-                    interval.lastPost = prevPost
+            # Anyone who was present at the previous post but not at
+            # this one has been deleted. Only go looking for them if
+            # someone is actually missing.
+            if stillPresentCount < prevPresentCount:
+                deletedContacts = [contactB for contactB, lastSeen in presentContacts.items()
+                                   if lastSeen != p]
+                for contactB in deletedContacts:
+                    del presentContacts[contactB]
+                    interval = intervals[contactB]
+                    if interval.lastPost == None:
+                        interval.lastPost = prevPost
 
             prevPost = p
-            prevPresentContacts = presentContacts
 
         # Go to the person who has this post in his session and also
         # has the longest-running session (newest last post). If his
         # session doesn't go any farther into the future than ours, then
         # we're done.
-        nextSessionA = max(posts[prevPost], key = lambda session: session.posts[-1])
+        nextSessionA = latestSessions[prevPost]
         if nextSessionA.posts[-1] <= sessionA.posts[-1]:
             break
         sessionA = nextSessionA
@@ -221,8 +344,8 @@ def buildConversationByPost(post):
             interval.lastPost = prevPost
 
     # Convert "intervals" from a contact -> (firstPost, lastPost) map
-    # to an array of (email, firstPost, lastPost) triples to pass to
-    # the Conversation constructor.
+    # to an array of Participants to pass to the Conversation
+    # constructor.
     participants = []
     for contact, interval in intervals.items():
         participants.append(Participant(contact.email, interval.firstPost, interval.lastPost))
@@ -270,125 +393,187 @@ def buildConversationByPost(post):
 #    With just the above posts, we have enough information to
 #    reconstruct the interval graph of all participants in the
 #    conversation.
-for filename in os.listdir('.'):
-    match = re.match("^([^ ]+).*\\.xml$", filename, re.IGNORECASE)
-    if not match:
-        continue
-
-    email = match.group(1)
-    eprint("reading %s" % filename)
-
-    if not (email in contacts):
-        contacts[email] = Contact(email)
-    contact = contacts[email]
-
-    prevTag = None
+def parseFile(filename):
+    # Returns a list of (sessionId, post) pairs for every post that
+    # should be saved, in the order they should be saved. This must not
+    # touch any global state, since it runs in a separate worker process.
+    try:
+        return parseFileUnchecked(filename)
+    except (etree.XMLSyntaxError, ValueError) as e:
+        # lxml's exceptions can't be pickled, so they can't be sent back
+        # to the main process; send back one that can, naming the file.
+        raise ValueError("%s: %s" % (filename, e))
+
+def parseFileUnchecked(filename):
+    savedPosts = []
+
+    # Most posts are never saved, so keep them as raw DateTime strings
+    # and only parse the ones that are.
+    prevWasJoin = False
     prevPost = None
     prevSessionId = None
 
-    for action, elem in etree.iterparse(filename, encoding='utf-8', events=["start"]):
+    # Only ask lxml for posts, so the tag filtering is done in C, and
+    # throw away each element once we're done with it. Otherwise lxml
+    # keeps the whole document tree in memory until the file has been
+    # fully read.
+    for action, elem in etree.iterparse(filename, encoding='utf-8', events=("end",),
+                                        tag=POST_TAGS):
         tag = elem.tag
 
-        if tag == 'Log':
-            # pre-allocate one Session object per session in the XML file
-            lastSessionId = int(elem.attrib['LastSessionID'])
-            contact.reserveSessions(lastSessionId)
-            continue
-
-        if (tag != 'Join' and tag != 'Message' and tag != 'Leave'
-            and tag != 'Invitation' and tag != 'InvitatationResponse'):
-            continue
-
-        sessionId = int(elem.attrib['SessionID'])
-        post = elem.attrib['DateTime']
+        sessionId = int(elem.get('SessionID'))
+        post = elem.get('DateTime')
         # eprint("%s:%s:%s" % (elem.tag, post, sessionId))
 
+        # free this element and any siblings that came before it
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
         # If we receive a Leave post, or this post starts a new session,
         # save the previous post.
-        if prevPost and (tag == 'Leave' or sessionId != prevSessionId):
-            contact.getSession(prevSessionId).addPost(prevPost)
+        if prevPost is not None and (tag == 'Leave' or sessionId != prevSessionId):
+            savedPosts.append((prevSessionId, parsePost(prevPost)))
 
         # If the previous post was a Join post, or if this post starts a
         # new session, save this post.
-        if prevTag == 'Join' or sessionId != prevSessionId:
-            contact.getSession(sessionId).addPost(post)
+        if prevWasJoin or sessionId != prevSessionId:
+            savedPosts.append((sessionId, parsePost(post)))
             # make sure we don't save this post twice
             post = None
 
-        prevTag = tag
+        prevWasJoin = (tag == 'Join')
         prevPost = post
         prevSessionId = sessionId
 
     # Save the final post of the final session.
-    if prevPost:
-        contact.getSession(prevSessionId).addPost(prevPost)
-
-# It's possible the first XML file for a contact was deleted, so
-# we don't have the first conversation (SessionID=1) with that
-# person in our logs. In that case, let's assume we had a 1-on-1
-# conversation with him long ago in the past.
-blankConvoCounter = 0
-for email, contact in contacts.items():
-    if len(contact.getSession(1).posts) == 0:
-        eprint(("warning: Failed to locate the first message (SessionID=1) with %s;"
-                + " as such, we must generate a blank conversation for this user."
-                + " Are you missing an XML file?") % email)
-        post = "0000-%010d" % blankConvoCounter
-        contact.getSession(1).addPost(post)
-        blankConvoCounter += 1
-
-for emailA, contactA in contacts.items():
-    eprint("calculating incoming edges for %s" % emailA)
-    firstPostA = contactA.getSession(1).posts[0]
-    lastPostA = contactA.getSession(1).posts[-1]
-    eprint("* first message with this user starts at time %s" % firstPostA)
-    eprint("* rebuilding conversation...")
-    convo = buildConversationByPost(firstPostA)
-    eprint("* done. conversation appears to span from %s to %s and has %d participants."
-           % (convo.firstPost, convo.lastPost, len(convo.participants)))
-
-    num_edges = 0
-
-    for emailB, firstPostB, lastPostB in convo.participants:
-        # Do not draw an edge if B is not a former contact to A.
-        contactB = contacts[emailB]
-        if not contactB.isFormerContactTo(contactA):
+    if prevPost is not None:
+        savedPosts.append((prevSessionId, parsePost(prevPost)))
+
+    return savedPosts
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--inDir', type=str, required=True,
+                        help="location of MSN chat logs (in XML format)")
+    parser.add_argument('-m', '--mainUsersEmail', type=str, required=True,
+                        help="main user's email")
+    args = parser.parse_args()
+
+    try:
+        os.chdir(args.inDir)
+    except OSError:
+        eprint("error: failed to change to directory '%s'" % args.inDir)
+        sys.exit(1)
+
+    # Each XML file can be parsed independently, so farm them out to a pool
+    # of worker processes and then replay the results here, in order.
+    filenames = []
+    emails = []
+    for filename in os.listdir('.'):
+        # "<email>[ anything].xml", case-insensitively; plain string
+        # operations are much cheaper than a regex here
+        if not filename.lower().endswith('.xml'):
+            continue
+        email = filename[:-4].split(' ', 1)[0]
+        if not email:
             continue
 
-        color = 'gray'
-
-        # If B joined the conversation before A left,
-        # recolor his edge to black.
-        if firstPostB <= lastPostA:
-            color = 'black'
-
-        # If B was in the conversation when A entered,
-        # recolor his edge to blue.
-        if firstPostB <= firstPostA and lastPostB >= firstPostA:
-            color = 'blue'
-
-        # If B was in the conversation when the conversation started
-        # (or the main user entered it), recolor his edge to green.
-        if firstPostB == convo.firstPost:
-            color = 'green'
-
-        edges.append(Edge(emailB, emailA, color))
-        num_edges += 1
-
-    # If we didn't draw any edges, at least draw an edge from the
-    # main user to us.
-    if num_edges == 0:
-        eprint("Adding an edge from the main user.")
-        edges.append(Edge(args.mainUsersEmail, emailA, 'black'))
-
-print('digraph G {')
-print(' graph[overlap=false, splines=ortho, fontname="Roboto"];')
-print(' node[shape=box, style=rounded, fontname="Roboto", fontsize=10];')
-print(' edge[fontname="Roboto"];')
-
-for edge in edges:
-    print(' "%s" -> "%s" [color=%s]' % (edge.src, edge.dest, edge.color))
-
-print('}')
+        filenames.append(filename)
+        emails.append(email)
+
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        try:
+            results = executor.map(parseFile, filenames, chunksize=8)
+            for filename, email, savedPosts in zip(filenames, emails, results):
+                # (the file has already been read by one of the workers)
+                eprint("adding posts from %s" % filename)
+
+                if not (email in contacts):
+                    contacts[email] = Contact(email)
+                contact = contacts[email]
+
+                for sessionId, post in savedPosts:
+                    contact.getSession(sessionId).addPost(post)
+        except ValueError as e:
+            eprint("error: %s" % e)
+            sys.exit(1)
+
+    # It's possible the first XML file for a contact was deleted, so
+    # we don't have the first conversation (SessionID=1) with that
+    # person in our logs. In that case, let's assume we had a 1-on-1
+    # conversation with him long ago in the past.
+    blankConvoCounter = 0
+    for email, contact in contacts.items():
+        if len(contact.getSession(1).posts) == 0:
+            eprint(("warning: Failed to locate the first message (SessionID=1) with %s;"
+                    + " as such, we must generate a blank conversation for this user."
+                    + " Are you missing an XML file?") % email)
+            post = BLANK_POST_BASE + blankConvoCounter
+            contact.getSession(1).addPost(post)
+            blankConvoCounter += 1
+
+    indexPosts()
+
+    for emailA, contactA in contacts.items():
+        eprint("calculating incoming edges for %s" % emailA)
+        firstPostA = contactA.getSession(1).posts[0]
+        lastPostA = contactA.getSession(1).posts[-1]
+        eprint("* first message with this user starts at time %s" % formatPost(firstPostA))
+        eprint("* rebuilding conversation...")
+        convo = contactA.getFirstConvo()
+        eprint("* done. conversation appears to span from %s to %s and has %d participants."
+               % (formatPost(convo.firstPost), formatPost(convo.lastPost), len(convo.participants)))
+
+        num_edges = 0
+
+        for par in convo.participants:
+            emailB = par.email
+            firstPostB = par.firstPost
+            lastPostB = par.lastPost
+
+            # Do not draw an edge if B is not a former contact to A.
+            contactB = contacts[emailB]
+            if not contactB.isFormerContactTo(contactA):
+                continue
 
-eprint('Done.')
+            # Pick the edge color, most important first: green, blue,
+            # black, then gray.
+            if firstPostB == convo.firstPost:
+                # B was in the conversation when the conversation started
+                # (or the main user entered it).
+                color = 'green'
+            elif firstPostB <= firstPostA <= lastPostB:
+                # B was in the conversation when A entered.
+                color = 'blue'
+            elif firstPostB <= lastPostA:
+                # B joined the conversation before A left.
+                color = 'black'
+            else:
+                color = 'gray'
+
+            edges.append((emailB, emailA, color))
+            num_edges += 1
+
+        # If we didn't draw any edges, at least draw an edge from the
+        # main user to us.
+        if num_edges == 0:
+            eprint("Adding an edge from the main user.")
+            edges.append((args.mainUsersEmail, emailA, 'black'))
+
+    # Write the whole graph out in one go, rather than making one
+    # print() call per edge.
+    lines = ['digraph G {',
+             ' graph[overlap=false, splines=ortho, fontname="Roboto"];',
+             ' node[shape=box, style=rounded, fontname="Roboto", fontsize=10];',
+             ' edge[fontname="Roboto"];']
+    lines.extend(' "%s" -> "%s" [color=%s]' % edge for edge in edges)
+    lines.append('}')
+    lines.append('')
+    sys.stdout.write('\n'.join(lines))
+    sys.stdout.flush()
+
+    eprint('Done.')
+
+if __name__ == '__main__':
+    main()